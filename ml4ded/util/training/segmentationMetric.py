@@ -21,19 +21,37 @@ class SegmentationMetric(object):
         self.reset()
 
     def update(self, preds, labels):
-        def evaluate_worker(self, pred, label):
-            correct, labeled = batch_pix_accuracy(pred, label)
-            inter, union = batch_intersection_union(pred, label, self.nclass)
-
-            self.total_correct += correct
-            self.total_label += labeled
-            if self.total_inter.device != inter.device:
-                self.total_inter = self.total_inter.to(inter.device)
-                self.total_union = self.total_union.to(union.device)
-            self.total_inter += inter
-            self.total_union += union
-
-        evaluate_worker(self, preds, labels.squeeze(1))
+        """
+        Args:
+            preds: (B, C, H, W) logits or (B, H, W) predicted class indices
+            labels: (B, H, W) or (B, 1, H, W) target class indices
+        """
+        labels = labels.squeeze(1)
+        if preds.dim() == labels.dim() + 1:
+            preds = torch.argmax(preds, 1)
+
+        pred = preds.long().flatten()
+        label = labels.long().flatten()
+        nclass = self.nclass
+
+        # Same counts as batch_pix_accuracy / batch_intersection_union, but from one confusion
+        # matrix built with bincount on the input device (no host copies or syncs per batch).
+        # Labels outside [0, nclass) (ignore index) land in an extra bin that is dropped.
+        valid = (label >= 0) & (label < nclass)
+        index = torch.where(valid, label * nclass + pred, torch.full_like(label, nclass * nclass))
+        hist = torch.bincount(index, minlength=nclass * nclass + 1)[:nclass * nclass].view(nclass, nclass)
+
+        inter = hist.diag().float()
+        area_pred = torch.bincount(pred, minlength=nclass)[:nclass].float()
+        union = area_pred + hist.sum(1).float() - inter
+
+        if self.total_inter.device != inter.device:
+            self.total_inter = self.total_inter.to(inter.device)
+            self.total_union = self.total_union.to(union.device)
+        self.total_correct += inter.sum()
+        self.total_label += (label >= 0).sum()
+        self.total_inter += inter
+        self.total_union += union
 
     def get(self):
         """
@@ -43,7 +61,7 @@ class SegmentationMetric(object):
             weighted_mIoU (float or None): weighted mean IoU if class_weights is set
         """
         eps = 2.220446049250313e-16
-        pixAcc = 1.0 * self.total_correct / (eps + self.total_label)
+        pixAcc = float(1.0 * self.total_correct / (eps + self.total_label))
         IoU = 1.0 * self.total_inter / (eps + self.total_union)
         mIoU = IoU.mean().item()
 
@@ -1,7 +1,7 @@
 import argparse
 import os
-import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from tqdm import tqdm
 import torch
@@ -16,7 +16,7 @@ sys.path.append(root_path)
 
 from ml4ded.models.dino2seg import Dino2Seg
 from ml4ded.util.training.segmentationMetric import *
-from ml4ded.util.vis import decode_segmap
+from ml4ded.util.vis import LABEL_COLORS, decode_segmap_tensor
 from ml4ded.util.dataset.ml4ded_seg_dataset import ML4DEDSegmentationDataset
 from ml4ded.util.training.early_stopping import EarlyStopping
 from ml4ded.util.dataset.augmentations.augmentations import get_train_augmentation, get_val_augmentation
@@ -30,6 +30,17 @@ class SegLabels(Enum):
     CURRENT_PART = 4
     WELD_FLASH = 5
 
+
+# CrossEntropyLoss / weighted mIoU weight per SegLabels name
+CLASS_WEIGHTS = {
+    "BACKGROUND": 0.1,
+    "HEAD": 0.1,
+    "BASEPLATE": 0.1,
+    "PREVIOUS_PART": 0.1,
+    "CURRENT_PART": 0.5,
+    "WELD_FLASH": 0.1,
+}
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Semantic Segmentation Training With Pytorch')
     parser.add_argument('--data-dir', type=str, default="./data/ml4ded",
@@ -44,13 +55,24 @@ def parse_args():
 
     parser.add_argument('--batch-size', type=int, default=6, metavar='N',
                         help='input batch size for training')
+    parser.add_argument('--accum-steps', type=int, default=1, metavar='N',
+                        help='number of batches to accumulate gradients over per optimizer step')
     parser.add_argument('--epochs', type=int, default=100, metavar='N',
                         help='number of epochs to train')
     parser.add_argument('--lr', type=float, default=1e-4, metavar='LR',
                         help='learning rate')
     parser.add_argument('--save-dir', default='./ckpt', help='Directory for saving checkpoint models')
     parser.add_argument('--device', default='cuda', help='Training device')
-    return parser.parse_args()
+    parser.add_argument('--amp', default='bf16', choices=['bf16', 'fp16', 'none'],
+                        help='mixed precision mode for forward/backward')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile')
+    parser.add_argument('--num-workers', type=int, default=min(8, os.cpu_count() or 1),
+                        help='number of dataloader worker processes')
+    args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error('--accum-steps must be at least 1')
+    return args
 
 
 def make_divisible(val, divisor=14):
@@ -67,6 +89,8 @@ class Trainer(object):
         default_data_dir = os.path.join(root_path, "data/ml4ded")
         # Adapt to your actual image size
         img_h, img_w = make_divisible(1072), make_divisible(608)
+        # documents the invariant make_divisible guarantees: whole 14px ViT patches, no padding in patch embedding
+        assert img_h % 14 == 0 and img_w % 14 == 0, f"image size {img_h}x{img_w} must be a multiple of the patch size"
 
         data_dir = args.data_dir if args.data_dir else default_data_dir
 
@@ -79,8 +103,12 @@ class Trainer(object):
         trainset = dataset_class(data_dir, split="train", mode="train", temporal_window=temporal_window, transform=train_transform)
         valset = dataset_class(data_dir, split="test", mode="val",temporal_window=temporal_window,  transform=val_transform)
         
-        self.train_loader = data.DataLoader(dataset=trainset, batch_size=args.batch_size, pin_memory=True)
-        self.val_loader = data.DataLoader(dataset=valset, batch_size=args.batch_size, pin_memory=True)
+        # persistent_workers/prefetch_factor are only valid with worker processes
+        loader_kwargs = dict(batch_size=args.batch_size, pin_memory=True, num_workers=args.num_workers)
+        if args.num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        self.train_loader = data.DataLoader(dataset=trainset, shuffle=True, drop_last=True, **loader_kwargs)
+        self.val_loader = data.DataLoader(dataset=valset, **loader_kwargs)
 
         self.model = Dino2Seg(
             encoder="vitb",
@@ -97,29 +125,31 @@ class Trainer(object):
             cross_attn_heads=4,
             device=self.device,
         )
-
-        class_weights = []
-        for seg_label in SegLabels:
-            match seg_label.name:
-                case "BACKGROUND":
-                    class_weights.append(0.1)
-                case "HEAD":
-                    class_weights.append(0.1)
-                case "BASEPLATE":
-                    class_weights.append(0.1)
-                case "PREVIOUS_PART":
-                    class_weights.append(0.1)
-                case "CURRENT_PART":
-                    class_weights.append(0.5)
-                case "WELD_FLASH":
-                    class_weights.append(0.1)
-
-        class_weights = torch.FloatTensor(class_weights).to(self.device)
+        # NHWC lets cuDNN pick tensor-core kernels for the patch embedding and decoder convs
+        self.model = self.model.to(memory_format=torch.channels_last)
+        if args.compile:
+            # compile in place so attribute access and seg_head state_dict keys stay unchanged;
+            # the previous-frame pass bypasses forward() and needs compiling on its own
+            self.model.compile(dynamic=False)
+            self.model.get_previous_temporal_tokens = torch.compile(self.model.get_previous_temporal_tokens,
+                                                                    dynamic=False)
+
+        class_weights = torch.tensor([CLASS_WEIGHTS[seg_label.name] for seg_label in SegLabels],
+                                     dtype=torch.float32, device=self.device)
 
         self.criterion = nn.CrossEntropyLoss(weight=class_weights, ignore_index=255)
+        # rebuilt every epoch by setup_training_schedule, which keeps the `pretrained` encoder frozen
         self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=args.lr)
+        # fp16 needs loss scaling to avoid gradient underflow, bf16 has enough range without it
+        self.use_amp = args.amp != 'none'
+        self.amp_dtype = torch.float16 if args.amp == 'fp16' else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=args.amp == 'fp16')
         self.metric = SegmentationMetric(len(trainset.classes), class_weights)
         self.best_pred = -1
+        # a single writer thread keeps checkpoints ordered while training continues
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_future = None
+        self.palette = torch.from_numpy(LABEL_COLORS).to(self.device)  # (N, 3) uint8 colour LUT
 
     def setup_training_schedule(self, epoch):
         """Setup training schedule based on current epoch"""
@@ -173,99 +203,111 @@ class Trainer(object):
 
     def train(self):
         iteration = 0
-        avg_loss = 0
-        for i in range(args.epochs):
-            print("-------------------------------------------------------")
-            print("Training Epoch {}/{}".format(i + 1, args.epochs))
-
-            # Setup training schedule for this epoch
-            self.setup_training_schedule(i)
-
-            self.model.train()
-            epoch_loss = 0
-            num_batches = 0
-
-            for images, targets, _ in tqdm(self.train_loader):
-                iteration += 1
-                num_batches += 1
-
-                # images: (B, T, 3, H, W), targets: (B, T, H, W)
-                images = images.to(self.device)
-                targets = targets.to(self.device)
-
-                current_images = images[:, -1]  # (B, 3, H, W)
-                current_targets = targets[:, -1]  # (B, H, W)
-
-                prev_temporal_images = images[:, :-1]  # (B, T-1, 3, H, W)
-                prev_temporal_images = prev_temporal_images.permute(1, 0, 2, 3, 4)  # (T-1, B, 3, H, W)
-
-                previous_temporal_tokens = self.model.get_previous_temporal_tokens(prev_temporal_images)
-
-                outputs, temporal_tokens , attn_weights= self.model(current_images, previous_temporal_tokens)  # shape (B, C, H, W)
-                pred = torch.max(outputs, 1).indices
-
-                loss = self.criterion(outputs, current_targets)
-                loss = torch.mean(loss)
-
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-
-                avg_loss += loss
-                epoch_loss += loss.item()
-
-                if iteration % 100 == 0:
-                    patch_h, patch_w = current_images.shape[-2] // 14, current_images.shape[-1] // 14
-                    print(f"epoch {i + 1} | iteration {iteration}: loss = {avg_loss.item() / 100:.4f}")
-                    writer.add_scalar('training loss', avg_loss.item() / 100, iteration)
-                    writer.add_scalar('temporal_gate', self.model.seg_head.gate.item(), iteration)
-
-                    # ---------- TEMPORAL TOKENS ----------
-                    temporal_tokens_vis = temporal_tokens[0].detach().cpu()  # (C, N_temp)
-                    writer.add_image("temporal_tokens/heatmap", temporal_tokens_vis.unsqueeze(0), iteration)
-                    writer.add_histogram("temporal_tokens/hist", temporal_tokens.detach().cpu(), iteration)
-
-                    # ---------- TEMPORAL ATTENTION (Single Head) ----------
-                    # attn_weights: (B, N_query, N_key)
-                    attn_weights_b0 = attn_weights[0].detach().cpu()  # (N_query, N_key)
-
-                    N_cls = 1 if self.model.use_clstoken else 0
-                    N_spatial = patch_h * patch_w
-                    temporal_start = N_cls + N_spatial
-
-                    # Extract temporal token rows only
-                    temporal_attn = attn_weights_b0[temporal_start:, :]  # (N_temp, N_key)
-
-                    # Normalize for visualization
-                    temporal_attn_norm = (temporal_attn - temporal_attn.min()) / (
-                                temporal_attn.max() - temporal_attn.min() + 1e-6)
-                    temporal_attn_img = temporal_attn_norm.unsqueeze(0)  # (1, 1, N_temp, N_key)
-                    temporal_attn = temporal_attn.unsqueeze(0)
-
-                    writer.add_image("attention_weights/temporal_only", temporal_attn_img, iteration)
-                    writer.add_histogram("attention_weights/temporal_only_hist", temporal_attn, iteration)
-
-                    avg_loss = 0  # Reset loss accumulator
-                if iteration % 500 == 1:
-                    pred_img = decode_segmap(pred[0].cpu().data.numpy())
-                    gt_img = decode_segmap(targets[0, -1].cpu().data.numpy())  # Use current target
-                    pred_img = torch.from_numpy(pred_img).permute(2, 0, 1)
-                    gt_img = torch.from_numpy(gt_img).permute(2, 0, 1)
-                    writer.add_image("pred", pred_img, iteration)
-                    writer.add_image("gt", gt_img, iteration)
-
-            # Log epoch statistics and final gate values for the epoch
-            avg_epoch_loss = epoch_loss / num_batches
-            print(f"Epoch {i + 1} average loss: {avg_epoch_loss:.4f}")
-            writer.add_scalar('epoch_loss', avg_epoch_loss, i)
-
-            # Validation
-            val_metric = self.validation(iteration, i)
-
-            self.early_stopper(val_metric)
-            if self.early_stopper.early_stop:
-                print(f"Early stopping at epoch {i + 1}")
-                break
+        avg_loss = 0.0
+        try:
+            for i in range(args.epochs):
+                print("-------------------------------------------------------")
+                print("Training Epoch {}/{}".format(i + 1, args.epochs))
+
+                # Setup training schedule for this epoch
+                self.setup_training_schedule(i)
+
+                self.model.train()
+                epoch_loss = 0
+                num_batches = 0
+                self.model.zero_grad(set_to_none=True)  # optimizer was rebuilt, drop any partial window
+
+                for images, targets, _ in tqdm(self.train_loader):
+                    iteration += 1
+                    num_batches += 1
+
+                    # images: (B, T, 3, H, W), targets: (B, T, H, W)
+                    images = images.to(self.device, non_blocking=True)
+                    targets = targets.to(self.device, non_blocking=True)
+
+                    current_images = images[:, -1].contiguous(memory_format=torch.channels_last)  # (B, 3, H, W)
+                    current_targets = targets[:, -1]  # (B, H, W)
+
+                    prev_temporal_images = images[:, :-1]  # (B, T-1, 3, H, W)
+                    prev_temporal_images = prev_temporal_images.permute(1, 0, 2, 3, 4)  # (T-1, B, 3, H, W)
+
+                    with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                        previous_temporal_tokens = self.model.get_previous_temporal_tokens(prev_temporal_images)
+
+                        outputs, temporal_tokens , attn_weights= self.model(current_images, previous_temporal_tokens)  # shape (B, C, H, W)
+
+                        loss = self.criterion(outputs, current_targets)
+
+                    # average over the accumulation window so the step matches one large batch
+                    self.scaler.scale(loss / self.args.accum_steps).backward()
+                    if num_batches % self.args.accum_steps == 0:
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.optimizer.zero_grad(set_to_none=True)
+
+                    # track as python floats so the autograd graph is not kept alive across iterations
+                    loss_value = loss.item()
+                    avg_loss += loss_value
+                    epoch_loss += loss_value
+
+                    if iteration % 100 == 0:
+                        patch_h, patch_w = current_images.shape[-2] // 14, current_images.shape[-1] // 14
+                        print(f"epoch {i + 1} | iteration {iteration}: loss = {avg_loss / 100:.4f}")
+                        writer.add_scalar('training loss', avg_loss / 100, iteration)
+                        writer.add_scalar('temporal_gate', self.model.seg_head.gate.item(), iteration)
+
+                        # ---------- TEMPORAL TOKENS ----------
+                        temporal_tokens_vis = temporal_tokens[0].detach().float().cpu()  # (C, N_temp)
+                        writer.add_image("temporal_tokens/heatmap", temporal_tokens_vis.unsqueeze(0), iteration)
+                        writer.add_histogram("temporal_tokens/hist", temporal_tokens.detach().float().cpu(), iteration)
+
+                        # ---------- TEMPORAL ATTENTION (Single Head) ----------
+                        # attn_weights: (B, N_query, N_key)
+                        attn_weights_b0 = attn_weights[0].detach().float().cpu()  # (N_query, N_key)
+
+                        N_cls = 1 if self.model.use_clstoken else 0
+                        N_spatial = patch_h * patch_w
+                        temporal_start = N_cls + N_spatial
+
+                        # Extract temporal token rows only
+                        temporal_attn = attn_weights_b0[temporal_start:, :]  # (N_temp, N_key)
+
+                        # Normalize for visualization
+                        temporal_attn_norm = (temporal_attn - temporal_attn.min()) / (
+                                    temporal_attn.max() - temporal_attn.min() + 1e-6)
+                        temporal_attn_img = temporal_attn_norm.unsqueeze(0)  # (1, 1, N_temp, N_key)
+                        temporal_attn = temporal_attn.unsqueeze(0)
+
+                        writer.add_image("attention_weights/temporal_only", temporal_attn_img, iteration)
+                        writer.add_histogram("attention_weights/temporal_only_hist", temporal_attn, iteration)
+
+                        avg_loss = 0.0  # Reset loss accumulator
+                    if iteration % 2000 == 1:
+                        pred = torch.argmax(outputs[0].detach(), dim=0)  # (H, W), first sample only
+                        # colour on device, only the (3, H, W) uint8 images are copied to host
+                        pred_img = decode_segmap_tensor(pred, self.palette).permute(2, 0, 1).cpu()
+                        gt_img = decode_segmap_tensor(current_targets[0], self.palette).permute(2, 0, 1).cpu()
+                        writer.add_image("pred", pred_img, iteration)
+                        writer.add_image("gt", gt_img, iteration)
+
+                # Log epoch statistics and final gate values for the epoch
+                avg_epoch_loss = epoch_loss / num_batches
+                print(f"Epoch {i + 1} average loss: {avg_epoch_loss:.4f}")
+                writer.add_scalar('epoch_loss', avg_epoch_loss, i)
+
+                # Validation
+                val_metric = self.validation(iteration, i)
+                writer.flush()
+
+                self.early_stopper(val_metric)
+                if self.early_stopper.early_stop:
+                    print(f"Early stopping at epoch {i + 1}")
+                    break
+
+            if self.checkpoint_future is not None:
+                self.checkpoint_future.result()  # surface errors from the last save
+        finally:
+            self.checkpoint_executor.shutdown(wait=True)
 
 
 
@@ -278,29 +320,37 @@ class Trainer(object):
         print("Evaluating")
         self.metric.reset()
 
-        for images, targets, _ in tqdm(self.val_loader):
-            images = images.to(self.device)  # (B, T, 3, H, W)
-            targets = targets.to(self.device)  # (B, T, H, W)
+        # no autograd recording or version counting during evaluation
+        with torch.inference_mode():
+            for images, targets, _ in tqdm(self.val_loader):
+                images = images.to(self.device, non_blocking=True)  # (B, T, 3, H, W)
+                targets = targets.to(self.device, non_blocking=True)  # (B, T, H, W)
 
-            current_images = images[:, -1]  # (B, 3, H, W)
-            current_targets = targets[:, -1]  # (B, H, W)
+                current_images = images[:, -1].contiguous(memory_format=torch.channels_last)  # (B, 3, H, W)
+                current_targets = targets[:, -1]  # (B, H, W)
+
+                prev_temporal_images = images[:, :-1]  # (B, T-1, 3, H, W)
+                prev_temporal_images = prev_temporal_images.permute(1, 0, 2, 3, 4)  # (T-1, B, 3, H, W)
 
-            prev_temporal_images = images[:, :-1]  # (B, T-1, 3, H, W)
-            prev_temporal_images = prev_temporal_images.permute(1, 0, 2, 3, 4)  # (T-1, B, 3, H, W)
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                    previous_temporal_tokens = self.model.get_previous_temporal_tokens(prev_temporal_images)
+                    outputs, pred_tokens, attn_weights = self.model(current_images, previous_temporal_tokens)  # (B, C, H, W)
+                    preds = torch.argmax(outputs, dim=1)  # (B, H, W)
+                del outputs  # only the label map is needed from here on
 
-            with torch.no_grad():
-                previous_temporal_tokens = self.model.get_previous_temporal_tokens(prev_temporal_images)
-                outputs, pred_tokens, attn_weights = self.model(current_images, previous_temporal_tokens)  # (B, C, H, W)
-                preds = torch.argmax(outputs, dim=1)  # (B, H, W)
+                self.metric.update(preds, current_targets)
 
-            self.metric.update(outputs, current_targets)
-            pixAcc, mIoU, weighted_mIoU = self.metric.get()
+                num_keep = 64 - sum(p.shape[0] for p in _preds)  # only log first few batches
+                if num_keep > 0:
+                    # keep compact label maps on device, copied to host once after the loop
+                    _preds.append(preds[:num_keep].to(torch.uint8))
+                    _targets.append(current_targets[:num_keep].to(torch.uint8))
 
-            for i in range(preds.shape[0]):
-                if len(_preds) < 64:  # only log first few batches
-                    _preds.append(torchvision.transforms.ToTensor()(decode_segmap(preds[i].cpu().numpy())))
-                    _targets.append(torchvision.transforms.ToTensor()(decode_segmap(current_targets[i].cpu().numpy())))
+        pixAcc, mIoU, weighted_mIoU = self.metric.get()
 
+        # colour on device, then (N, H, W, 3) uint8 -> (N, 3, H, W) float in [0, 1] like ToTensor
+        _preds = decode_segmap_tensor(torch.cat(_preds), self.palette).permute(0, 3, 1, 2).cpu().float().div(255)
+        _targets = decode_segmap_tensor(torch.cat(_targets), self.palette).permute(0, 3, 1, 2).cpu().float().div(255)
         _preds = torchvision.utils.make_grid(_preds, nrow=8)
         _targets = torchvision.utils.make_grid(_targets, nrow=8)
 
@@ -309,36 +359,46 @@ class Trainer(object):
         writer.add_scalar('validation pixAcc', pixAcc, it)
         writer.add_scalar('validation mIoU', mIoU, it)
         writer.add_scalar('validation weighted mIoU', weighted_mIoU, it)
-        # writer.add_image("val_gt", _targets, it)
-        # writer.add_image("val_pred", _preds, it)
+        writer.add_image("val_gt", _targets, it)
+        writer.add_image("val_pred", _preds, it)
 
         if new_pred > self.best_pred:
             is_best = True
             self.best_pred = new_pred
 
-        save_checkpoint(self.model, self.args, is_best)
+        # snapshot to host memory now, serialize in the background
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in self.model.seg_head.state_dict().items()}
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()  # surface errors from the previous save
+        self.checkpoint_future = self.checkpoint_executor.submit(save_checkpoint, state_dict, self.args, is_best)
         return new_pred
 
 
-def save_checkpoint(model, args, is_best=False):
+def save_checkpoint(state_dict, args, is_best=False):
     """Save Checkpoint"""
     directory = os.path.expanduser(args.save_dir)
     if not os.path.exists(directory):
         os.makedirs(directory)
     filename = f"dinov2_seg.pth"
     filename = os.path.join(directory, filename)
-    torch.save(model.seg_head.state_dict(), filename)
+    torch.save(state_dict, filename)
     if is_best:
         best_filename = 'dinov2_seg_best_model.pth'
         best_filename = os.path.join(directory, best_filename)
-        shutil.copyfile(filename, best_filename)
+        torch.save(state_dict, best_filename)
 
 
 if __name__ == '__main__':
     args = parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = '0'
     args.device = "cuda"
-    writer = SummaryWriter()
+    # input shape is fixed, so let cuDNN autotune once and use TF32 tensor cores for fp32 math
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    # events are queued in memory and flushed explicitly once per epoch
+    writer = SummaryWriter(max_queue=1000, flush_secs=120)
     trainer = Trainer(args)
     trainer.train()
     torch.cuda.empty_cache()
@@ -1,19 +1,22 @@
 import numpy as np
 
+# NYUv2 40-class color palette (taken from official toolbox, can be customized)
+LABEL_COLORS = np.array([
+    (  0,   0,   0), (  0, 128, 128), (  0,   0, 128), (  0, 128,   0),
+    (128,  64, 128), (128,   0, 128), (128, 128, 128), ( 64,   0, 128),
+    (192,   0, 128), ( 64, 128, 128), (192, 128, 128), ( 64,   0,   0),
+    (192,   0,   0), ( 64, 128,   0), (192, 128,   0), ( 64,  64,   0),
+    (192,  64,   0), ( 64,   0,  64), (192,   0,  64), (  0, 192,   0),
+    (128, 192,   0), (  0,  64, 128), (128,  64,   0), (  0, 192, 128),
+    (128, 192, 128), (  0,  64,   0), (128,  64, 128), (  0, 192,  64),
+    (128, 192,  64), (  0,  64,  64), (128,  64,  64), (192, 192,   0),
+    ( 64, 192,   0), (192,  64,   0), ( 64, 192, 128), (192, 192, 128),
+    ( 64,  64, 128), (192,  64, 128), ( 64, 192,  64), (192, 192,  64),
+], dtype=np.uint8)
+
+
 def decode_segmap(image, nc=40):
-    # NYUv2 40-class color palette (taken from official toolbox, can be customized)
-    label_colors = np.array([
-        (  0,   0,   0), (  0, 128, 128), (  0,   0, 128), (  0, 128,   0),
-        (128,  64, 128), (128,   0, 128), (128, 128, 128), ( 64,   0, 128),
-        (192,   0, 128), ( 64, 128, 128), (192, 128, 128), ( 64,   0,   0),
-        (192,   0,   0), ( 64, 128,   0), (192, 128,   0), ( 64,  64,   0),
-        (192,  64,   0), ( 64,   0,  64), (192,   0,  64), (  0, 192,   0),
-        (128, 192,   0), (  0,  64, 128), (128,  64,   0), (  0, 192, 128),
-        (128, 192, 128), (  0,  64,   0), (128,  64, 128), (  0, 192,  64),
-        (128, 192,  64), (  0,  64,  64), (128,  64,  64), (192, 192,   0),
-        ( 64, 192,   0), (192,  64,   0), ( 64, 192, 128), (192, 192, 128),
-        ( 64,  64, 128), (192,  64, 128), ( 64, 192,  64), (192, 192,  64),
-    ])
+    label_colors = LABEL_COLORS
     # Ensure label_colors matches the number of classes
     assert label_colors.shape[0] >= nc, f"Color map only covers {label_colors.shape[0]} classes, need {nc}."
 
@@ -28,3 +31,18 @@ def decode_segmap(image, nc=40):
         b[idx] = label_colors[l, 2]
     rgb = np.stack([r, g, b], axis=2)
     return rgb
+
+
+def decode_segmap_tensor(labels, palette):
+    """
+    Vectorized decode_segmap for tensors, runs on whatever device labels/palette live on.
+
+    Args:
+        labels: (..., H, W) integer class indices
+        palette: (N, 3) uint8 tensor, e.g. torch.from_numpy(LABEL_COLORS)
+    Returns:
+        (..., H, W, 3) uint8 RGB tensor, labels outside the palette are black
+    """
+    labels = labels.long()
+    labels = labels.masked_fill(labels >= palette.shape[0], 0)
+    return palette[labels]